@@ -4,7 +4,7 @@ import hashlib
 import time
 
 
-from threading import Thread
+from threading import Lock, Thread
 from dataclasses import dataclass
 from db import DBHandler
 
@@ -25,7 +25,7 @@ class ConfigMonitor:
         master_config: PodMonitorConfig,
         coordinator_config: PodMonitorConfig,
         worker_config: PodMonitorConfig,
-
+        nodes_lock: Lock,
     ) -> None:
         self.master_provision_path = master_config.monitor_file
         self.coordinator_provision_path = coordinator_config.monitor_file
@@ -40,6 +40,7 @@ class ConfigMonitor:
         self.workers = worker_config.pod_names
         self.coordinator = coordinator_config.pod_names
         self.masters = master_config.pod_names
+        self.nodes_lock = nodes_lock
 
     @staticmethod
     def load_config_map(config_path: str) -> typing.List[str]:
@@ -49,19 +50,23 @@ class ConfigMonitor:
 
         return read_config(config_path)
 
+    def snapshot(self, pod_names: typing.Set[str]) -> typing.List[str]:
+        with self.nodes_lock:
+            return list(pod_names)
+
     def update_masters(self):
         log.info("Update masters with new config")
-        for pod in self.masters:
+        for pod in self.snapshot(self.masters):
             self.provision_master(pod)
 
     def update_coordinator(self):
         log.info("Update masters with new config")
-        for pod in self.masters:
+        for pod in self.snapshot(self.masters):
             self.provision_coordinator(pod)
 
     def update_workers(self):
         log.info("Update workers with new config")
-        for pod in self.workers:
+        for pod in self.snapshot(self.workers):
             self.provision_worker(pod)
 
     def provision_master(self, pod_name: str) -> None:
@@ -112,7 +117,7 @@ class FileWatcher:
                 self.compare_hashs_for_update(new_hash)
                 time.sleep(5)
 
-        Thread(target=run).start()
+        Thread(target=run, daemon=True).start()
 
     def compare_hashs_for_update(self, new_hash: bytes) -> None:
         if new_hash != self.current_hash:
@@ -1,5 +1,6 @@
 import typing
 import psycopg2
+import psycopg2.extras
 import retrying
 import logging
 
@@ -68,4 +69,29 @@ class DBHandler:
         with self._connect_to_db(host) as conn:
             with conn.cursor() as cur:
                 log.info("Executing query %s with %s", query, query_params)
-                cur.execute(query, query_params)
\ No newline at end of file
+                cur.execute(query, query_params)
+
+    def execute_many(
+        self,
+        pod_name: str,
+        service_name: str,
+        query: str,
+        params_list: typing.List[dict],
+    ) -> None:
+        if not params_list:
+            return
+        host = self.get_host_name(pod_name, service_name)
+        batch_failed = False
+        with self._connect_to_db(host) as conn:
+            with conn.cursor() as cur:
+                log.info("Executing query %s with %s", query, params_list)
+                try:
+                    psycopg2.extras.execute_batch(cur, query, params_list)
+                except psycopg2.Error as e:
+                    log.error("Batch query failed on %s: %s", pod_name, e)
+                    conn.rollback()
+                    batch_failed = True
+        if batch_failed:
+            log.info("Retrying query row by row on %s", pod_name)
+            for query_params in params_list:
+                self.execute_query(pod_name, service_name, query, query_params)
@@ -22,6 +22,7 @@ class EnvConf:
     minimum_workers: int
     short_url: bool
     ssl_mode: str
+    config_path: str
 
 
 def parse_env_vars() -> EnvConf:
@@ -41,6 +42,7 @@ def parse_env_vars() -> EnvConf:
         int(env.get("MINIMUM_WORKERS", 0)),
         bool(env.get("SHORT_URL", False)),
         env.get("SSL_MODE", ""),
+        env.get("CONFIG_PATH", "/etc/citus-config/"),
     )
     log.info("Environment Config: %s", conf)
     return conf
\ No newline at end of file
@@ -1,13 +1,17 @@
 
+import os
 import typing
-import retrying
 import json
 import logging
+import signal
 
+from concurrent.futures import ThreadPoolExecutor
 from kubernetes import client, config, watch
-from kubernetes.client import V1Pod
+from kubernetes.client import V1ObjectMeta, V1Pod
+from urllib3.exceptions import HTTPError
 from flask import Flask
-from threading import Thread
+from waitress import serve
+from threading import Event, Lock, Thread
 from env_conf import parse_env_vars
 from db import DBHandler
 from config_monitor import ConfigMonitor, PodMonitorConfig
@@ -22,37 +26,55 @@ logging.basicConfig(
 log = logging.getLogger(__file__)
 
 
-class ReadinessError(Exception):
+class ShutdownRequested(Exception):
     pass
 
 
 class Manager:
 
-    config_path = "/etc/citus-config/"
+    watch_timeout = 600
+    reconnect_wait = 5
+    api_pool_size = 4
+    fanout_workers = 8
+    add_node_query = "SELECT master_add_node(%(host)s, %(port)s)"
 
     def __init__(self) -> None:
 
         self.conf = parse_env_vars()
+        self._master_setup = os.path.join(self.conf.config_path, "master.setup")
+        self._coordinator_setup = os.path.join(
+            self.conf.config_path, "coordinator.setup"
+        )
+        self._worker_setup = os.path.join(self.conf.config_path, "worker.setup")
         self.db_handler = DBHandler(self.conf)
+        self._core_v1 = self.create_core_api()
         self.init_provision = False
+        self._last_rv: typing.Optional[str] = None
+        self._needs_relist = False
+        self._stop = Event()
+        self._handling_event = False
+        self._pool = ThreadPoolExecutor(max_workers=self.fanout_workers)
+        self.label_selector = "citusType in ({},{},{})".format(
+            self.conf.master_label, self.conf.coordinator_label, self.conf.worker_label
+        )
 
         self.citus_master_nodes: typing.Set[str] = set()
         self.citus_worker_nodes: typing.Set[str] = set()
         self.citus_coordinator_nodes: typing.Set[str] = set()
+        self._registered_json: typing.Optional[str] = None
+        self._nodes_lock = Lock()
+        self.pending_pods: typing.Set[str] = set()
+        self.registered_uids: typing.Dict[str, str] = {}
         self.start_web_server()
         self.pod_interactions: typing.Dict[
-            str, typing.Dict[str, typing.Callable[[str], None]]
+            typing.Tuple[str, str], typing.Callable[[V1Pod], None]
         ] = {
-            "ADDED": {
-                self.conf.master_label: self.add_master,
-                self.conf.coordinator_label: self.add_coordinator,
-                self.conf.worker_label: self.add_worker,
-            },
-            "DELETED": {
-                self.conf.master_label: self.remove_master,
-                self.conf.coordinator_label: self.remove_coordinator,
-                self.conf.worker_label: self.remove_worker,
-            },
+            ("ADDED", self.conf.master_label): self.add_master,
+            ("ADDED", self.conf.coordinator_label): self.add_coordinator,
+            ("ADDED", self.conf.worker_label): self.add_worker,
+            ("DELETED", self.conf.master_label): self.remove_master,
+            ("DELETED", self.conf.coordinator_label): self.remove_coordinator,
+            ("DELETED", self.conf.worker_label): self.remove_worker,
         }
         self.config_monitor = self.create_provision_monitor()
         self.config_monitor.start_watchers()
@@ -60,25 +82,37 @@ class Manager:
     def create_provision_monitor(self) -> ConfigMonitor:
         master_config = PodMonitorConfig(
             self.citus_master_nodes,
-            self.config_path + "master.setup",
+            self._master_setup,
             self.conf.master_service,
         )
         coordinator_config = PodMonitorConfig(
             self.citus_coordinator_nodes,
-            self.config_path + "coordinator.setup",
+            self._coordinator_setup,
             self.conf.coordinator_service,
         )
         worker_config = PodMonitorConfig(
             self.citus_worker_nodes,
-            self.config_path + "worker.setup",
+            self._worker_setup,
             self.conf.worker_service,
         )
-        return ConfigMonitor(self.db_handler, master_config, coordinator_config, worker_config)
+        return ConfigMonitor(
+            self.db_handler,
+            master_config,
+            coordinator_config,
+            worker_config,
+            self._nodes_lock,
+        )
+
+    def create_core_api(self) -> client.CoreV1Api:
+        config.load_incluster_config()  # or load_kube_config for external debugging
+        configuration = client.Configuration()
+        configuration.connection_pool_maxsize = self.api_pool_size
+        return client.CoreV1Api(client.ApiClient(configuration))
 
     @staticmethod
     def get_citus_type(pod: V1Pod) -> str:
         labels = pod.metadata.labels
-        log.info("Retrieved labels: %s", labels)
+        log.debug("Retrieved labels: %s", labels)
         if not labels:
             return ""
         return labels.get("citusType", "")
@@ -86,123 +120,265 @@ class Manager:
     def run(self) -> None:
         log.info("Starting to watch citus db pods in {}".format(self.conf.namespace))
 
-        config.load_incluster_config()  # or load_kube_config for external debugging
-        api = client.CoreV1Api()
         w = watch.Watch()
-        for event in w.stream(api.list_namespaced_pod, self.conf.namespace):
-            citus_type, pod_name, event_type = self.parse_event(event)
-            if not citus_type or event_type not in self.pod_interactions:
+        signal.signal(signal.SIGTERM, lambda *_: self.request_stop(w))
+        try:
+            while not self._stop.is_set():
+                try:
+                    if self._needs_relist:
+                        self.relist_pods()
+                    self.watch_pods(w)
+                except client.rest.ApiException as e:
+                    if e.status == 410:
+                        self.expire_resource_version()
+                        continue
+                    log.error("Error while watching pods: %s", e)
+                    self._stop.wait(self.reconnect_wait)
+                except HTTPError as e:
+                    log.info("Watch connection lost: %s", e)
+                    self._stop.wait(self.reconnect_wait)
+        except ShutdownRequested:
+            pass
+        log.info("Stopped watching citus db pods")
+        self._pool.shutdown()
+
+    def request_stop(self, w: watch.Watch) -> None:
+        if self._stop.is_set():
+            return
+        log.info("Received SIGTERM, shutting down")
+        self._stop.set()
+        w.stop()
+        # Interrupt a blocking read on the watch stream, but let an event that is
+        # being handled finish so no half-applied node changes are left behind.
+        if not self._handling_event:
+            raise ShutdownRequested()
+
+    def watch_pods(self, w: watch.Watch) -> None:
+        kwargs: typing.Dict[str, typing.Any] = {
+            "label_selector": self.label_selector,
+            "timeout_seconds": self.watch_timeout,
+        }
+        if self._last_rv:
+            kwargs["resource_version"] = self._last_rv
+        for event in w.stream(
+            self._core_v1.list_namespaced_pod, self.conf.namespace, **kwargs
+        ):
+            if event["type"] == "ERROR":
+                status = event["raw_object"]
+                if status.get("code") == 410:
+                    self.expire_resource_version()
+                    return
+                log.error("Error event while watching pods: %s", status)
                 continue
-            handler = self.pod_interactions[event_type]
-            if citus_type not in handler:
-                log.error("Not recognized citus type %s", citus_type)
+            self._last_rv = event["object"].metadata.resource_version
+            if event["type"] == "BOOKMARK":
                 continue
+            self._handling_event = True
             try:
-                handler[citus_type](pod_name)
-            except ReadinessError as e:
-                log.error(e)
-
-    def parse_event(self, event: dict) -> typing.Tuple[str, str, str]:
+                self.handle_event(event)
+            finally:
+                self._handling_event = False
+            if self._stop.is_set():
+                return
+
+    def expire_resource_version(self) -> None:
+        log.info("Resource version %s expired, relisting pods", self._last_rv)
+        self._last_rv = None
+        self._needs_relist = True
+
+    def relist_pods(self) -> None:
+        self._handling_event = True
+        try:
+            pod_list = self._core_v1.list_namespaced_pod(
+                self.conf.namespace, label_selector=self.label_selector
+            )
+            self.reconcile_pods(pod_list.items)
+        finally:
+            self._handling_event = False
+        self._last_rv = pod_list.metadata.resource_version
+        self._needs_relist = False
+
+    def reconcile_pods(self, pods: typing.List[V1Pod]) -> None:
+        # A relist carries no DELETED events for pods removed while the watch
+        # was down, so unregister every known pod missing from the list.
+        listed = {pod.metadata.name for pod in pods}
+        self.pending_pods &= listed
+        removers = (
+            (self.citus_master_nodes, self.remove_master),
+            (self.citus_coordinator_nodes, self.remove_coordinator),
+            (self.citus_worker_nodes, self.remove_worker),
+        )
+        for nodes, remove in removers:
+            for pod_name in set(self._snapshot(nodes)) - listed:
+                log.info("Pod %s disappeared while the watch was down", pod_name)
+                remove(V1Pod(metadata=V1ObjectMeta(name=pod_name)))
+        for pod in pods:
+            self.handle_event({"type": "ADDED", "object": pod})
+
+    def handle_event(self, event: dict) -> None:
+        citus_type, pod, event_type = self.parse_event(event)
+        pod_name = pod.metadata.name
+        if event_type == "MODIFIED" and pod_name in self.pending_pods:
+            event_type = "ADDED"
+        elif event_type == "DELETED":
+            self.pending_pods.discard(pod_name)
+        handler = self.pod_interactions.get((event_type, citus_type))
+        if handler is None:
+            return
+        handler(pod)
+
+    def parse_event(self, event: dict) -> typing.Tuple[str, V1Pod, str]:
         event_type = event["type"]
         pod = event["object"]
         citus_type = self.get_citus_type(pod)
-        pod_name = pod.metadata.name
         if citus_type:
             log.info(
                 "New event %s for pod %s with citus type %s",
                 event_type,
-                pod_name,
+                pod.metadata.name,
                 citus_type,
             )
-        return citus_type, pod_name, event_type
-
-    def check_pod_readiness(self, pod_name: str) -> None:
-        @retrying.retry(
-            wait_fixed=5000,
-            retry_on_exception=lambda x: not isinstance(x, client.rest.ApiException),
-        )
-        def request_pod_readiness():
-            api = client.CoreV1Api()
-            pod = api.read_namespaced_pod_status(pod_name, self.conf.namespace)
-            status = pod.status
-            readiness = [state.ready for state in status.container_statuses]
-            log.info("Status: %s, %s", pod_name, readiness)
-            assert all(readiness)
-            log.info("Pod %s ready", pod_name)
+        return citus_type, pod, event_type
 
-        try:
-            request_pod_readiness()
-        except client.rest.ApiException as e:
-            log.info("Error while waiting for pod readiness: %s", pod_name)
-            raise ReadinessError(e)
+    def check_pod_readiness(self, pod: V1Pod) -> bool:
+        pod_name = pod.metadata.name
+        statuses = (pod.status and pod.status.container_statuses) or []
+        readiness = [state.ready for state in statuses]
+        log.debug("Status: %s, %s", pod_name, readiness)
+        if readiness and all(readiness):
+            self.pending_pods.discard(pod_name)
+            log.info("Pod %s ready", pod_name)
+            return True
+        if pod_name in self.pending_pods:
+            log.debug("Pod %s still not ready", pod_name)
+        else:
+            log.info("Pod %s not ready, waiting for status updates", pod_name)
+            self.pending_pods.add(pod_name)
+        return False
 
     def start_web_server(self) -> None:
         app = Flask(__name__)
 
         @app.route("/registered")
         def registered_workers() -> str:
-            pods = {
-                "workers": list(self.citus_worker_nodes),
-                "coordinator": list(self.citus_coordinator_nodes),
-                "masters": list(self.citus_master_nodes),
-            }
-            return json.dumps(pods)
-
-        Thread(target=app.run).start()
-
-    def add_master(self, pod_name: str) -> None:
-        self.check_pod_readiness(pod_name)
+            with self._nodes_lock:
+                if self._registered_json is None:
+                    pods = {
+                        "workers": list(self.citus_worker_nodes),
+                        "coordinator": list(self.citus_coordinator_nodes),
+                        "masters": list(self.citus_master_nodes),
+                    }
+                    self._registered_json = json.dumps(pods)
+                return self._registered_json
+
+        Thread(
+            target=serve,
+            args=(app,),
+            kwargs={"host": "127.0.0.1", "port": 5000, "threads": 2},
+            daemon=True,
+        ).start()
+
+    def _snapshot(self, nodes: typing.Set[str]) -> typing.List[str]:
+        with self._nodes_lock:
+            return list(nodes)
+
+    def is_registered(self, pod: V1Pod) -> bool:
+        # StatefulSet pods keep their name when recreated, so match on uid.
+        uid = self.registered_uids.get(pod.metadata.name)
+        return uid is not None and uid == pod.metadata.uid
+
+    def add_master(self, pod: V1Pod) -> None:
+        pod_name = pod.metadata.name
+        if self.is_registered(pod):
+            log.info("Pod %s already registered", pod_name)
+            return
+        if not self.check_pod_readiness(pod):
+            return
         log.info("Registering new master %s", pod_name)
-        self.citus_master_nodes.add(pod_name)
-        self.set_coordinator_master(pod_name)
+        with self._nodes_lock:
+            self.citus_master_nodes.add(pod_name)
+            self.registered_uids[pod_name] = pod.metadata.uid
+            self._registered_json = None
+        self._set_coordinator(pod_name, self.conf.master_service)
         if len(self.citus_worker_nodes) >= self.conf.minimum_workers:
             self.config_monitor.provision_master(pod_name)
-        for worker_pod in self.citus_worker_nodes:
-            self.add_worker(worker_pod)
+        self._provision_workers_on(
+            pod_name, self.conf.master_service, self._snapshot(self.citus_worker_nodes)
+        )
 
-    def remove_master(self, pod_name: str) -> None:
-        self.citus_master_nodes.discard(pod_name)
+    def remove_master(self, pod: V1Pod) -> None:
+        pod_name = pod.metadata.name
+        with self._nodes_lock:
+            self.citus_master_nodes.discard(pod_name)
+            self.registered_uids.pop(pod_name, None)
+            self._registered_json = None
         log.info("Unregistered: %s", pod_name)
 
-    def add_coordinator(self, pod_name: str) -> None:
-        self.check_pod_readiness(pod_name)
+    def add_coordinator(self, pod: V1Pod) -> None:
+        pod_name = pod.metadata.name
+        if self.is_registered(pod):
+            log.info("Pod %s already registered", pod_name)
+            return
+        if not self.check_pod_readiness(pod):
+            return
         log.info("Registering new master %s", pod_name)
-        self.citus_coordinator_nodes.add(pod_name)
-        self.set_coordinator_coordinator(pod_name)
+        with self._nodes_lock:
+            self.citus_coordinator_nodes.add(pod_name)
+            self.registered_uids[pod_name] = pod.metadata.uid
+            self._registered_json = None
+        self._set_coordinator(pod_name, self.conf.coordinator_service)
         if len(self.citus_worker_nodes) >= self.conf.minimum_workers:
             self.config_monitor.provision_coordinator(pod_name)
-        for worker_pod in self.citus_worker_nodes:
-            self.add_worker(worker_pod)
+        self._provision_workers_on(
+            pod_name,
+            self.conf.coordinator_service,
+            self._snapshot(self.citus_worker_nodes),
+        )
 
-    def remove_coordinator(self, pod_name: str) -> None:
-        self.citus_coordinator_nodes.discard(pod_name)
+    def remove_coordinator(self, pod: V1Pod) -> None:
+        pod_name = pod.metadata.name
+        with self._nodes_lock:
+            self.citus_coordinator_nodes.discard(pod_name)
+            self.registered_uids.pop(pod_name, None)
+            self._registered_json = None
         log.info("Unregistered: %s", pod_name)
 
-    def set_coordinator_master(self, pod_name: str) -> None:
+    def _set_coordinator(self, pod_name: str, service_name: str) -> None:
         log.info("Registering new coordinator %s", pod_name)
-        service_name = self.conf.master_service
-        master_host = self.db_handler.get_host_name(
-                pod_name, self.conf.master_service
-            ) 
-        query_params = {"host": master_host, "port": self.conf.pg_port}
-        self.db_handler.execute_query(pod_name, service_name, """SELECT citus_set_coordinator_host(%(host)s)""", query_params)
-
-    def set_coordinator_coordinator(self, pod_name: str) -> None:
-        log.info("Registering new coordinator %s", pod_name)
-        service_name = self.conf.coordinator_service
-        coordinator_host = self.db_handler.get_host_name(
-                pod_name, self.conf.coordinator_service
-            ) 
-        query_params = {"host": coordinator_host, "port": self.conf.pg_port}
-        self.db_handler.execute_query(pod_name, service_name, """SELECT citus_set_coordinator_host(%(host)s)""", query_params)
-        
-    def add_worker(self, pod_name: str) -> None:
-        self.check_pod_readiness(pod_name)
+        host = self.db_handler.get_host_name(pod_name, service_name)
+        query_params = {"host": host, "port": self.conf.pg_port}
+        self.db_handler.execute_query(
+            pod_name,
+            service_name,
+            "SELECT citus_set_coordinator_host(%(host)s)",
+            query_params,
+        )
+
+    def add_worker(self, pod: V1Pod) -> None:
+        pod_name = pod.metadata.name
+        if self.is_registered(pod):
+            log.info("Pod %s already registered", pod_name)
+            return
+        if not self.check_pod_readiness(pod):
+            return
         log.info("Registering new worker %s", pod_name)
-        self.citus_worker_nodes.add(pod_name)
+        with self._nodes_lock:
+            self.citus_worker_nodes.add(pod_name)
+            self.registered_uids[pod_name] = pod.metadata.uid
+            self._registered_json = None
 
-        self.exec_on_masters("SELECT master_add_node(%(host)s, %(port)s)", pod_name)
-        self.exec_on_coordinators("SELECT master_add_node(%(host)s, %(port)s)", pod_name)
+        self._exec_on(
+            self.citus_master_nodes,
+            self.conf.master_service,
+            self.add_node_query,
+            pod_name,
+        )
+        self._exec_on(
+            self.citus_coordinator_nodes,
+            self.conf.coordinator_service,
+            self.add_node_query,
+            pod_name,
+        )
         if len(self.citus_worker_nodes) >= self.conf.minimum_workers:
             if not self.init_provision:
                 self.config_monitor.provision_all_nodes()
@@ -210,35 +386,53 @@ class Manager:
             else:
                 self.config_monitor.provision_worker(pod_name)
 
-    def remove_worker(self, worker_name: str) -> None:
+    def _provision_workers_on(
+        self, node_name: str, service_name: str, worker_names: typing.Iterable[str]
+    ) -> None:
+        params_list = [
+            {
+                "host": self.db_handler.get_host_name(
+                    worker_name, self.conf.worker_service
+                ),
+                "port": self.conf.pg_port,
+            }
+            for worker_name in worker_names
+        ]
+        self.db_handler.execute_many(
+            node_name, service_name, self.add_node_query, params_list
+        )
+
+    def remove_worker(self, pod: V1Pod) -> None:
+        worker_name = pod.metadata.name
         log.info("Worker terminated: %s", worker_name)
-        self.citus_worker_nodes.discard(worker_name)
-        self.exec_on_masters(
+        with self._nodes_lock:
+            self.citus_worker_nodes.discard(worker_name)
+            self.registered_uids.pop(worker_name, None)
+            self._registered_json = None
+        self._exec_on(
+            self.citus_master_nodes,
+            self.conf.master_service,
             """DELETE FROM pg_dist_shard_placement WHERE nodename=%(host)s AND nodeport=%(port)s;
             SELECT master_remove_node(%(host)s, %(port)s)""",
             worker_name,
         )
         log.info("Unregistered: %s", worker_name)
 
-    def exec_on_masters(self, query: str, worker_name: str) -> None:
-        for master in self.citus_master_nodes:
-            worker_host = self.db_handler.get_host_name(
-                worker_name, self.conf.worker_service
-            )
-            query_params = {"host": worker_host, "port": self.conf.pg_port}
-            self.db_handler.execute_query(
-                master, self.conf.master_service, query, query_params
-            )
-
-    def exec_on_coordinators(self, query: str, worker_name: str) -> None:
-        for coordinator in self.citus_coordinator_nodes:
-            worker_host = self.db_handler.get_host_name(
-                worker_name, self.conf.worker_service
-            )
-            query_params = {"host": worker_host, "port": self.conf.pg_port}
-            self.db_handler.execute_query(
-                coordinator, self.conf.coordinator_service, query, query_params
+    def _exec_on(
+        self, nodes: typing.Set[str], service_name: str, query: str, worker_name: str
+    ) -> None:
+        worker_host = self.db_handler.get_host_name(
+            worker_name, self.conf.worker_service
+        )
+        query_params = {"host": worker_host, "port": self.conf.pg_port}
+        list(
+            self._pool.map(
+                lambda node: self.db_handler.execute_query(
+                    node, service_name, query, query_params
+                ),
+                self._snapshot(nodes),
             )
+        )
 
 if __name__ == "__main__":
     manager = Manager()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The manager modules import each other as top level modules (see Dockerfile).
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "manager"))
@@ -0,0 +1,66 @@
+import typing
+import pytest
+import manager
+
+from kubernetes import client
+from kubernetes.client import V1ListMeta, V1PodList
+from urllib3.exceptions import ProtocolError
+
+
+class FakeCoreApi:
+    def __init__(self) -> None:
+        self.list_calls = 0
+
+    def list_namespaced_pod(self, namespace: str, **kwargs) -> V1PodList:
+        self.list_calls += 1
+        if self.list_calls == 1:
+            raise ProtocolError("Connection aborted")
+        return V1PodList(items=[], metadata=V1ListMeta(resource_version="42"))
+
+
+class FakeWatch:
+    def __init__(self, stop: typing.Callable[[], None]) -> None:
+        self.stop_manager = stop
+        self.streams: typing.List[dict] = []
+
+    def stop(self) -> None:
+        pass
+
+    def stream(self, func, namespace: str, **kwargs) -> typing.Iterator[dict]:
+        self.streams.append(kwargs)
+        if len(self.streams) == 1:
+            raise client.rest.ApiException(status=410, reason="Gone")
+        self.stop_manager()
+        return iter([])
+
+
+class FakeMonitor:
+    def start_watchers(self) -> None:
+        pass
+
+
+@pytest.fixture()
+def citus_manager(monkeypatch):
+    monkeypatch.setenv("NAMESPACE", "unit-test")
+    monkeypatch.setattr(manager.Manager, "create_core_api", lambda self: None)
+    monkeypatch.setattr(manager.Manager, "start_web_server", lambda self: None)
+    monkeypatch.setattr(
+        manager.Manager, "create_provision_monitor", lambda self: FakeMonitor()
+    )
+    monkeypatch.setattr(manager.signal, "signal", lambda *args: None)
+    mgr = manager.Manager()
+    mgr.reconnect_wait = 0
+    mgr._core_v1 = FakeCoreApi()
+    return mgr
+
+
+def test_failed_relist_after_gone_is_retried(citus_manager, monkeypatch):
+    fake_watch = FakeWatch(citus_manager._stop.set)
+    monkeypatch.setattr(manager.watch, "Watch", lambda: fake_watch)
+
+    citus_manager.run()
+
+    assert citus_manager._core_v1.list_calls == 2
+    assert len(fake_watch.streams) == 2
+    assert fake_watch.streams[1]["resource_version"] == "42"
+    assert not citus_manager._needs_relist